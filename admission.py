@@ -0,0 +1,91 @@
+import math
+import os
+from urllib.parse import urlsplit
+
+RATE_CLIENT_PER_SEC = float(os.getenv("RATE_CLIENT_PER_SEC", 5))
+RATE_CLIENT_BURST = int(os.getenv("RATE_CLIENT_BURST", 20))
+RATE_TARGET_PER_SEC = float(os.getenv("RATE_TARGET_PER_SEC", 2))
+RATE_TARGET_BURST = int(os.getenv("RATE_TARGET_BURST", 10))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", 1000))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", 5))
+
+# Несколько token bucket сразу: токены списываются, только если хватает во всех.
+# ARGV: тройки cost/rate/burst для каждого ключа
+TOKEN_BUCKETS_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local tokens = {}
+local retry = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 3 - 1])
+    local burst = tonumber(ARGV[i * 3])
+    -- запрос дороже всего ведра иначе не прошёл бы никогда: берём его, когда ведро полное
+    local cost = math.min(tonumber(ARGV[i * 3 - 2]), burst)
+    local b = redis.call('HMGET', key, 'tokens', 'ts')
+    local level = tonumber(b[1]) or burst
+    local ts = tonumber(b[2]) or now
+    level = math.min(burst, level + math.max(0, now - ts) * rate)
+    if level < cost then
+        retry = math.max(retry, (cost - level) / rate)
+    end
+    tokens[i] = level
+end
+local allowed = retry == 0 and 1 or 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 3 - 1])
+    local burst = tonumber(ARGV[i * 3])
+    local cost = math.min(tonumber(ARGV[i * 3 - 2]), burst)
+    if allowed == 1 then
+        tokens[i] = tokens[i] - cost
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens[i]), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+end
+return {allowed, tostring(tokens[1]), tostring(retry)}
+"""
+
+
+def target_host(target: str) -> str:
+    if "://" in target:
+        return (urlsplit(target).hostname or target).lower()
+    host = target.split("/")[0]
+    if host.count(":") == 1:
+        host = host.split(":")[0]
+    return host.strip("[]").lower()
+
+
+class Rejected(Exception):
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+# Допуск проверок: сначала глубина локальных очередей, затем лимиты на клиента и на целевой хост
+class AdmissionControl:
+    def __init__(self, redis_client, scheduler):
+        self.redis = redis_client
+        self.scheduler = scheduler
+        self.buckets = redis_client.register_script(TOKEN_BUCKETS_LUA)
+
+    async def admit(self, client: str, target: str, cost: int = 1) -> dict:
+        # client — IP клиента; cost — сколько проверок реально будет запущено
+        depth = await self.scheduler.depth()
+        if depth >= ADMISSION_MAX_QUEUE:
+            raise Rejected("Check queue is full", ADMISSION_RETRY_AFTER)
+
+        allowed, remaining, retry = await self.buckets(
+            keys=[f"rl:client:{client}", f"rl:target:{target_host(target)}"],
+            args=[
+                cost, RATE_CLIENT_PER_SEC, RATE_CLIENT_BURST,
+                cost, RATE_TARGET_PER_SEC, RATE_TARGET_BURST
+            ]
+        )
+        if not allowed:
+            raise Rejected("Rate limit exceeded", max(1, math.ceil(float(retry))))
+
+        return {
+            "X-RateLimit-Limit": str(RATE_CLIENT_BURST),
+            "X-RateLimit-Remaining": str(int(float(remaining))),
+            "X-Queue-Depth": str(depth)
+        }
@@ -1,7 +1,7 @@
 import streamlit as st
 import pandas as pd
 from sqlalchemy import create_engine, select
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, undefer
 from database import Base
 from models import Task, Result, Agents, ActiveAgents, Admin
 
@@ -15,7 +15,8 @@ SessionLocal = sessionmaker(bind=engine)
 def fetch_data(model):
     try:
         with SessionLocal() as session:
-            result = session.execute(select(model))
+            # Result.data отложенная колонка — грузим всё сразу, пока сессия открыта
+            result = session.execute(select(model).options(undefer("*")))
             data = result.scalars().all()
         return data
     except Exception as e:
@@ -0,0 +1,124 @@
+import json
+import zlib
+
+import orjson
+from sqlalchemy import LargeBinary, text
+from sqlalchemy.types import TypeDecorator
+
+# Формат: [флаг сжатия][код типа проверки][тело]
+# Тело — orjson массива полей в фиксированном порядке, без повторяющихся ключей
+RAW = 0
+ZLIB = 1
+COMPRESS_THRESHOLD = 512
+
+GENERIC = 0
+
+# type -> (code, поля в порядке хранения)
+SCHEMAS = {
+    "http": (1, ("url", "headers")),
+    "ping": (2, ("output",)),
+    "tcp": (3, ("host", "port")),
+    "traceroute": (4, ("trace",)),
+    "dns": (5, ("records",)),
+}
+TYPES_BY_CODE = {code: (name, fields) for name, (code, fields) in SCHEMAS.items()}
+
+
+def _pack_field(name, value):
+    if name == "headers":
+        return [x for kv in value.items() for x in kv]
+    if name == "trace":
+        return "\n".join(value) if value else None
+    return value
+
+
+def _unpack_field(name, value):
+    if name == "headers":
+        return dict(zip(value[::2], value[1::2]))
+    if name == "trace":
+        return value.split("\n") if value is not None else []
+    return value
+
+
+def _schema_for(data: dict):
+    schema = SCHEMAS.get(data.get("type"))
+    if not schema:
+        return None
+    code, fields = schema
+    if set(data) != {"type", *fields}:
+        return None
+    if "headers" in fields and not isinstance(data["headers"], dict):
+        return None
+    if "trace" in fields and not (isinstance(data["trace"], list) and all(isinstance(x, str) and "\n" not in x for x in data["trace"])):
+        return None
+    return schema
+
+
+def encode_payload(data) -> bytes | None:
+    if data is None:
+        return None
+
+    schema = _schema_for(data) if isinstance(data, dict) else None
+    if schema:
+        code, fields = schema
+        body = orjson.dumps([_pack_field(f, data[f]) for f in fields])
+    else:
+        code = GENERIC
+        body = orjson.dumps(data)
+
+    if len(body) > COMPRESS_THRESHOLD:
+        return bytes((ZLIB, code)) + zlib.compress(body, 6)
+    return bytes((RAW, code)) + body
+
+
+def decode_payload(blob):
+    if blob is None:
+        return None
+    if isinstance(blob, str):
+        # строки, записанные до перехода на бинарный формат
+        return json.loads(blob)
+
+    blob = bytes(blob)
+    flag, code = blob[0], blob[1]
+    body = blob[2:]
+    if flag == ZLIB:
+        body = zlib.decompress(body)
+    value = orjson.loads(body)
+
+    if code == GENERIC:
+        return value
+    name, fields = TYPES_BY_CODE[code]
+    data = {f: _unpack_field(f, v) for f, v in zip(fields, value)}
+    data["type"] = name
+    return data
+
+
+class PackedJSON(TypeDecorator):
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return encode_payload(value)
+
+    def process_result_value(self, value, dialect):
+        return decode_payload(value)
+
+
+def migrate_result_payloads(conn, batch_size: int = 500):
+    # Перекодирует старые JSON-строки в results.data; читаем сырым SQL, минуя PackedJSON
+    migrated = 0
+    while True:
+        rows = conn.execute(
+            text("SELECT id, data FROM results WHERE typeof(data) = 'text' LIMIT :n"),
+            {"n": batch_size}
+        ).all()
+        if not rows:
+            break
+        conn.execute(
+            text("UPDATE results SET data = :data WHERE id = :id"),
+            [{"id": r.id, "data": encode_payload(json.loads(r.data))} for r in rows]
+        )
+        migrated += len(rows)
+    if migrated:
+        print(f"📦 Migrated {migrated} result payloads to packed format")
+    return migrated
@@ -1,7 +1,9 @@
-from fastapi import FastAPI, Depends, WebSocket, WebSocketDisconnect, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, Depends, WebSocket, WebSocketDisconnect, HTTPException, Request, Response
+from pydantic import BaseModel, Field
+from typing import Literal
 from uuid import uuid4
-import asyncio, time, httpx, dns.resolver, json
+import asyncio, time, httpx, dns.asyncresolver, random, socket
+from urllib.parse import urlsplit, urlunsplit, urljoin
 import redis.asyncio as redis
 import secrets
 import os
@@ -13,15 +15,21 @@ from datetime import datetime, timedelta
 import jwt
 from fastapi.security import OAuth2PasswordBearer
 from keys import secretik
-from sqlalchemy import insert
+from sqlalchemy import insert, func
 from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
-from database import Base, engine, get_db
+from sqlalchemy.orm import undefer
+from database import Base, engine, get_db, AsyncSessionLocal, add_missing_columns
 from models import Task, Result, Agents, ActiveAgents, Admin
 from smtp import send_api
+from codec import migrate_result_payloads
+from online_hub import OnlineHub
+from scheduler import Scheduler
+from admission import AdmissionControl, Rejected, target_host
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy import Column, String
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
+from serialization import dumps, loads, negotiate_format, send_frame, receive_frame
 
 
 pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
@@ -32,12 +40,75 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/login")
 app = FastAPI(title="Aeza x Culture Union", description="API для проверки DNS записей и не только", version="1.0.0", docs_url="/papers", openapi_url="/openapi.json",
-    openapi_version="3.1.0")
+    openapi_version="3.1.0", default_response_class=ORJSONResponse)
 
 active_agents: dict[str, WebSocket] = {}
 redis_client = redis.Redis(host='localhost', port=6379, db=0, encoding="utf-8", decode_responses=True)
 # redis_client = redis.Redis(host=os.getenv('REDIS_HOST', 'localhost'), port=6379, db=0, encoding="utf-8", decode_responses=True)
 
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", 3600))
+
+# check:{id} hash -> kind, expected, done, r:{result_id} -> json результата
+# HSET возвращает 1 только для нового поля, так что повторный результат от агента не накручивает done
+CACHE_RESULT_LUA = """
+local added = redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+if added == 1 then
+    redis.call('HINCRBY', KEYS[1], 'done', 1)
+end
+if ARGV[4] == 'single' then
+    redis.call('HSETNX', KEYS[1], 'kind', 'single')
+    redis.call('HSETNX', KEYS[1], 'expected', 1)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return added
+"""
+cache_result_script = redis_client.register_script(CACHE_RESULT_LUA)
+
+# Пересборка hash после промаха: поля результатов дописываются без DEL (параллельный результат не теряется),
+# done пересчитывается по фактическому числу r:* полей
+REBUILD_CHECK_LUA = """
+redis.call('HSET', KEYS[1], 'kind', ARGV[1], 'expected', ARGV[2])
+for i = 4, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+local done = 0
+for _, field in ipairs(redis.call('HKEYS', KEYS[1])) do
+    if string.sub(field, 1, 2) == 'r:' then
+        done = done + 1
+    end
+end
+redis.call('HSET', KEYS[1], 'done', done)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return done
+"""
+rebuild_check_script = redis_client.register_script(REBUILD_CHECK_LUA)
+
+LEASE_TIMEOUT = int(os.getenv("LEASE_TIMEOUT", 30))
+LEASE_MAX_ATTEMPTS = int(os.getenv("LEASE_MAX_ATTEMPTS", 3))
+LEASE_KEY = "task_leases"
+LEASE_DATA_KEY = "task_lease_data"
+
+# Забираем аренду атомарно: ZREM вернёт 1 только одному из конкурентов (результат, реапер, дисконнект)
+CLAIM_LEASE_LUA = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return false
+end
+local lease = redis.call('HGET', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+return lease
+"""
+claim_lease_script = redis_client.register_script(CLAIM_LEASE_LUA)
+
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", 5))
+scheduler = Scheduler(redis_client)
+admission = AdmissionControl(redis_client, scheduler)
+
+online_hub = OnlineHub(
+    redis_client,
+    coalesce=float(os.getenv("ONLINE_COALESCE", 0.25)),
+    keepalive=float(os.getenv("ONLINE_KEEPALIVE", 15))
+)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -49,6 +120,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After", "X-RateLimit-Limit", "X-RateLimit-Remaining", "X-Queue-Depth"],
 )
 
 
@@ -82,11 +154,128 @@ async def checkalka_redisa():
     except Exception as e:
         raise RuntimeError(f"Redis connection failed: {e}")
 
+def check_key(check_id: str) -> str:
+    return f"check:{check_id}"
+
+
+def result_to_dict(res: Result) -> dict:
+    out = {
+        "type": res.data.get("type") if res.data else None,
+        "status": res.status,
+        "code": res.code,
+        "response_time": res.response_time,
+        "data": res.data,
+        "error": res.error
+    }
+    if res.agent:
+        out["vantage"] = {"agent": res.agent, "region": res.region}
+    return out
+
+
+async def track_check(check_id: str, expected: int, kind: str):
+    key = check_key(check_id)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(key, mapping={"kind": kind, "expected": expected, "done": 0})
+        pipe.expire(key, RESULT_CACHE_TTL)
+        await pipe.execute()
+
+
+async def cache_result(res: Result):
+    try:
+        await cache_result_script(
+            keys=[check_key(res.group_id or res.id)],
+            args=[f"r:{res.id}", dumps(result_to_dict(res)), RESULT_CACHE_TTL, "" if res.group_id else "single"]
+        )
+    except Exception as e:
+        print(f"⚠️ Result {res.id} not cached: {e}")
+        # иначе опросы будут видеть устаревший pending из кэша, хотя результат уже в БД
+        try:
+            await redis_client.delete(check_key(res.group_id or res.id))
+        except Exception:
+            pass
+
+
+async def rebuild_check_cache(check_id: str, kind: str, expected: int, results: list[Result]):
+    fields = []
+    for r in results:
+        fields += [f"r:{r.id}", dumps(result_to_dict(r))]
+    try:
+        await rebuild_check_script(keys=[check_key(check_id)], args=[kind, expected, RESULT_CACHE_TTL, *fields])
+    except Exception as e:
+        print(f"⚠️ Check {check_id} not cached: {e}")
+
+
+async def save_result(db: AsyncSession, res: Result):
+    # Переданная задача может финишировать дважды: поздний результат агента и локальный воркер
+    try:
+        if await db.get(Result, res.id):
+            print(f"↩️ Result {res.id} already stored, skipping duplicate")
+            return
+        db.add(res)
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    await cache_result(res)
+
+
+def check_view(check_id: str, kind: str, expected: int, done: int, results: list[dict]) -> dict:
+    if kind == "single":
+        if not results:
+            return {"id": check_id, "status": "pending"}
+        res = dict(results[0])
+        res.pop("type", None)
+        return {"id": check_id} | res
+
+    if not results:
+        return {"id": check_id, "status": "pending"}
+    view = {
+        "id": check_id,
+        "status": "completed" if done >= expected else "pending",
+        "results": results
+    }
+    if kind == "fanout":
+        view["summary"] = fanout_summary(expected, results)
+    return view
+
+
+def fanout_summary(expected: int, results: list[dict]) -> dict:
+    ok = sum(1 for r in results if r["status"] == "ok")
+    if ok == len(results):
+        consensus = "up"
+    elif ok == 0:
+        consensus = "down"
+    else:
+        consensus = "partial"
+    return {
+        "consensus": consensus,
+        "ok": ok,
+        "finished": len(results),
+        "expected": expected,
+        "vantages": [
+            {
+                **(r.get("vantage") or {"agent": None, "region": None}),
+                "status": r["status"],
+                "response_time": r["response_time"]
+            }
+            for r in results
+        ]
+    }
+
+
+class FanoutSpec(BaseModel):
+    mode: Literal["all", "region", "k"] = "all"
+    k: int | None = Field(default=None, ge=1)
+    regions: list[str] | None = None
+    labels: list[str] | None = None
+
 class CheckRequest(BaseModel):
     target: str
     type: str
     port: int | None = None
     record_type: str | None = None
+    fanout: FanoutSpec | None = None
+    priority: Literal["interactive", "bulk"] | None = None
 class AgentApiKeyRequest(BaseModel):
     api_key: str
     name: str | None = None
@@ -95,6 +284,8 @@ class AgentRegisterRequest(BaseModel):
     name: str
     desc: str
     email: str
+    region: str | None = None
+    labels: list[str] | None = None
 
 class AdminLoginRequest(BaseModel):
     username: str
@@ -104,13 +295,38 @@ class AdminLoginRequest(BaseModel):
 async def startup():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(add_missing_columns)
+        await conn.run_sync(migrate_result_payloads)
     await checkalka_redisa()
-    for i in range(5):
+    for i in range(WORKER_CONCURRENCY):
         asyncio.create_task(worker(i))
+    asyncio.create_task(online_hub.run())
+    asyncio.create_task(lease_reaper())
 
 
 @app.post("/api/checks", tags=["Main Reqs"])
-async def checkkk(req: CheckRequest, db: AsyncSession = Depends(get_db)):
+async def checkkk(req: CheckRequest, request: Request, response: Response, db: AsyncSession = Depends(get_db)):
+    if req.type == "full" and req.fanout:
+        raise HTTPException(status_code=422, detail="Fan-out is not supported for full checks")
+
+    vantages = None
+    if req.fanout:
+        vantages = pick_vantages(req.fanout)
+        if not vantages:
+            raise HTTPException(status_code=503, detail="No connected agents match fan-out spec")
+
+    # Лимит на клиента считается по IP: клиентских ключей в системе нет, а ключи агентов —
+    # их секреты, просить клиентов присылать их нельзя
+    client = request.client.host
+
+    # fan-out порождает по задаче на каждую точку — столько и списываем с обоих ведер
+    cost = len(vantages) if vantages else 5 if req.type == "full" else 1
+    try:
+        limits = await admission.admit(client, req.target, cost=cost)
+    except Rejected as e:
+        raise HTTPException(status_code=429, detail=e.reason, headers={"Retry-After": str(e.retry_after)})
+    response.headers.update(limits)
+
     if req.type == "full":
         group_id = str(uuid4())
 
@@ -132,33 +348,35 @@ async def checkkk(req: CheckRequest, db: AsyncSession = Depends(get_db)):
             {"type": "dns"}
         ]
 
-        sub_task_ids = []
+        subtasks = []
         for ch in checks:
             sub_id = str(uuid4())
-            sub_task_ids.append(sub_id)
-            new_task = Task(
+            db.add(Task(
                 id=sub_id,
                 target=req.target,
                 type=ch["type"],
                 port=ch.get("port", req.port),
                 record_type=None,
                 group_id=group_id
-            )
-            db.add(new_task)
-            task_data = {
-                "id": sub_id,
-                "group_id": group_id,
-                "target": req.target,
-                "type": ch["type"],
-                "port": ch.get("port", req.port),
-                "record_type": None
-            }
-            await redis_client.lpush("task_queue", json.dumps(task_data))
-            print(f"📦 Sub-task {sub_id} added to Redis queue for group {group_id}")
+            ))
+            subtasks.append({"id": sub_id, "type": ch["type"], "port": ch.get("port", req.port)})
 
         await db.commit()
+        await track_check(group_id, len(checks), "full")
+
+        task_data = {
+            "id": group_id,
+            "target": req.target,
+            "type": "full",
+            "subtasks": subtasks,
+            "priority": req.priority or "bulk"
+        }
+        await scheduler.enqueue(task_data, task_data["priority"])
+        print(f"📦 Full check {group_id} added to Redis queue ({len(subtasks)} probes)")
 
         return {"id": group_id, "status": "queued"}
+    if req.fanout:
+        return await fanout_check(req, db, vantages)
     task_id = str(uuid4())
     new_task = Task(
         id=task_id,
@@ -169,52 +387,91 @@ async def checkkk(req: CheckRequest, db: AsyncSession = Depends(get_db)):
     )
     db.add(new_task)
     await db.commit()
+    await track_check(task_id, 1, "single")
 
-    task_data = req.model_dump() | {"id": task_id}
+    task_data = req.model_dump(exclude={"fanout"}) | {"id": task_id, "priority": req.priority or "interactive"}
     await dispatch_task(task_data)
     return {"id": task_id, "status": "queued"}
 
 
 @app.get("/api/checks/{task_id}", tags=["Main Reqs"])
 async def get_check(task_id: str, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(Result).where(Result.id == task_id))
+    try:
+        cached = await redis_client.hgetall(check_key(task_id))
+    except Exception as e:
+        print(f"⚠️ Cache read for {task_id} failed, using DB: {e}")
+        cached = {}
+    if cached.get("expected"):
+        results = [loads(v) for k, v in cached.items() if k.startswith("r:")]
+        return check_view(task_id, cached["kind"], int(cached["expected"]), int(cached.get("done", 0)), results)
+
+    result = await db.execute(select(Result).options(undefer(Result.data)).where(Result.id == task_id))
     rec = result.scalar()
     if rec:
-        return {
-            "id": rec.id,
-            "status": rec.status,
-            "code": rec.code,
-            "response_time": rec.response_time,
-            "data": rec.data,
-            "error": rec.error
-        }
+        # подзадачу группы кэшируем под её собственным id, а не в hash группы
+        await rebuild_check_cache(task_id, "single", 1, [rec])
+        return check_view(task_id, "single", 1, 1, [result_to_dict(rec)])
 
-    results = await db.execute(select(Result).where(Result.group_id == task_id))
+    results = await db.execute(select(Result).options(undefer(Result.data)).where(Result.group_id == task_id))
     res_list = results.scalars().all()
+    if not res_list:
+        return {"id": task_id, "status": "pending"}
 
-    if res_list:
-        return {
-            "id": task_id,
-            "status": "completed" if all(r.status != "pending" for r in res_list) else "pending",
-            "results": [
-                {
-                    "type": r.data.get("type") if r.data else None,
-                    "status": r.status,
-                    "code": r.code,
-                    "response_time": r.response_time,
-                    "data": r.data,
-                    "error": r.error
-                }
-                for r in res_list
-            ]
+    main_task = await db.get(Task, task_id)
+    expected = await db.scalar(
+        select(func.count()).select_from(Task).where(Task.group_id == task_id, Task.id != task_id)
+    )
+    kind = "fanout" if main_task and main_task.type == "fanout" else "full"
+    await rebuild_check_cache(task_id, kind, expected, res_list)
+    return check_view(task_id, kind, expected, len(res_list), [result_to_dict(r) for r in res_list])
+
+
+def pick_vantages(spec: FanoutSpec) -> list[tuple[str, str, str | None]]:
+    # снимок (api_key, имя, регион): агент может отвалиться, пока запрос ждёт admission/БД
+    candidates = []
+    for api_key, ws in list(active_agents.items()):
+        if spec.regions and ws.state.region not in spec.regions:
+            continue
+        if spec.labels and not set(spec.labels) <= set(ws.state.labels):
+            continue
+        candidates.append((api_key, ws.state.agent_name, ws.state.region))
+
+    if spec.mode == "region":
+        by_region = {}
+        for vantage in candidates:
+            by_region.setdefault(vantage[2], []).append(vantage)
+        return [random.choice(group) for group in by_region.values()]
+    if spec.mode == "k":
+        return random.sample(candidates, min(spec.k or 1, len(candidates)))
+    return candidates
+
+
+async def fanout_check(req: CheckRequest, db: AsyncSession, vantages: list[tuple[str, str, str | None]]):
+    group_id = str(uuid4())
+    db.add(Task(id=group_id, target=req.target, type="fanout", port=req.port, record_type=req.record_type, group_id=group_id))
+
+    dispatches = []
+    for api_key, agent_name, region in vantages:
+        sub_id = str(uuid4())
+        db.add(Task(id=sub_id, target=req.target, type=req.type, port=req.port, record_type=req.record_type, group_id=group_id))
+        task_data = req.model_dump(exclude={"fanout"}) | {
+            "id": sub_id,
+            "group_id": group_id,
+            "region": region,
+            "vantage": {"agent": agent_name, "region": region}
         }
+        dispatches.append((task_data, api_key))
+    await db.commit()
+    await track_check(group_id, len(dispatches), "fanout")
 
-    task_query = await db.execute(select(Task).where(Task.id == task_id))
-    main_task = task_query.scalar()
-    if main_task and main_task.type == "full":
-        return {"id": task_id, "status": "pending"}
-
-    return {"id": task_id, "status": "pending"}
+    # ушедшего агента dispatch_task заменит другим из региона или запишет точку как упавшую
+    await asyncio.gather(*(dispatch_task(task_data, api_key=api_key) for task_data, api_key in dispatches))
+    print(f"🌍 Fan-out {group_id}: {req.type} {req.target} on {len(dispatches)} agents")
+    return {
+        "id": group_id,
+        "status": "queued",
+        "vantages": [{"agent": agent_name, "region": region} for _, agent_name, region in vantages]
+    }
 
 @app.delete("/api/agents/{agent_id}", tags=["Admin Reqs"])
 async def delete_agent(agent_id: str, db: AsyncSession = Depends(get_db), current_admin: Admin = Depends(get_adm)):
@@ -236,145 +493,218 @@ async def delete_agent(agent_id: str, db: AsyncSession = Depends(get_db), curren
                 del active_agents[a.api]
             except:
                 del active_agents[a.api]
+    await online_hub.agent_offline(a.api)
     return {"message": f"Agent {agent_id} deleted"}
 
-async def worker(worker_id: int):
-    async with AsyncSession(engine) as db:
-        while True:
-            task_json = await redis_client.brpop("task_queue", timeout=5)
-            if not task_json:
-                continue
+async def resolve_target(target: str) -> str | None:
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(target_host(target), None, type=socket.SOCK_STREAM)
+        return infos[0][4][0]
+    except Exception:
+        return None
 
-            task = json.loads(task_json[1])
-            start = time.time()
-            try:
-                if task["type"] == "http":
-                    async with httpx.AsyncClient(follow_redirects=True) as client:
-                        r = await client.get(task["target"], timeout=5)
-                        data = {
-                            "headers": dict(r.headers),
-                            "url": str(r.url),
-                            "type": "http"
-                        }
-                        status = "ok" if r.status_code < 400 else "fail"
-                        db.add(Result(
-                            id=task["id"],
-                            status=status,
-                            code=r.status_code,
-                            response_time=time.time()-start,
-                            data=data,
-                            group_id=task.get("group_id")
-                        ))
-                        await db.commit()
-
-                elif task["type"] == "ping":
-                    proc = await asyncio.create_subprocess_shell(
-                        f"/bin/ping -c 1 {task['target']}",
-                        stdout=asyncio.subprocess.PIPE,
-                        stderr=asyncio.subprocess.PIPE)
-                    out, err = await proc.communicate()
-                    encoding = locale.getpreferredencoding(False)
-                    out_decoded = out.decode(encoding, errors="replace")
-                    err_decoded = err.decode(encoding, errors="replace")
-
-                    ok = proc.returncode == 0
-                    resp_time = None
-                    if ok and "time=" in out_decoded:
-                        try:
-                            line = out_decoded.split("time=")[1]
-                            resp_time = float(line.split(" ")[0])
-                        except:
-                            pass
-
-                    db.add(Result(
-                        id=task["id"],
-                        status="ok" if ok else "fail",
-                        response_time=resp_time,
-                        data={
-                            "output": out_decoded,
-                            "type": "ping"
-                        },
-                        error=None if ok else err_decoded,
-                        group_id=task.get("group_id")
-                    ))
-                    await db.commit()
-
-                elif task["type"] == "tcp":
-                    host, port = task["target"], task.get("port", 80)
-                    try:
-                        reader, writer = await asyncio.open_connection(host, port)
-                        writer.close()
-                        await writer.wait_closed()
-                        ok = True
-                        err = None
-                    except Exception as e:
-                        ok = False
-                        err = str(e)
-                    db.add(Result(
-                        id=task["id"],
-                        status="ok" if ok else "fail",
-                        response_time=time.time()-start,
-                        data={
-                            "host": host,
-                            "port": port,
-                            "type": "tcp"
-                        },
-                        error=err,
-                        group_id=task.get("group_id")
-                    ))
-                    await db.commit()
-
-                elif task["type"] == "traceroute":
-                    proc = await asyncio.create_subprocess_shell(
-                        f"/bin/traceroute -m 10 -w 2 {task['target']}",
-                        stdout=asyncio.subprocess.PIPE,
-                        stderr=asyncio.subprocess.PIPE)
-                    out, err = await proc.communicate()
-                    ok = proc.returncode == 0
-                    db.add(Result(
-                        id=task["id"],
-                        status="ok" if ok else "fail",
-                        response_time=time.time()-start,
-                        data={
-                            "trace": out.decode().splitlines(),
-                            "type": "traceroute"
-                        },
-                        error=None if ok else err.decode(),
-                        group_id=task.get("group_id")
-                    ))
-                    await db.commit()
-
-                elif task["type"] == "dns":
-                    resolver = dns.resolver.Resolver()
-                    record_types = ["A", "AAAA", "MX", "NS", "TXT", "CNAME"]
-                    dns_results = {}
-                    for rt in record_types:
-                        try:
-                            answer = resolver.resolve(task["target"], rt)
-                            dns_results[rt] = [rdata.to_text() for rdata in answer]
-                        except Exception as e:
-                            dns_results[rt] = {"error": str(e)}
-                    db.add(Result(
-                        id=task["id"],
-                        status="ok",
-                        response_time=time.time() - start,
-                        data={
-                            "records": dns_results,
-                            "type": "dns"
-                        },
-                        group_id=task.get("group_id")
-                    ))
-                    await db.commit()
 
-            except Exception as e:
-                db.add(Result(
+async def run_probe(task: dict, ip: str | None = None) -> Result:
+    # ip — заранее разрешённый адрес цели (общий для всех проб full-проверки)
+    start = time.time()
+    try:
+        if task["type"] == "http":
+            url, extensions, headers = task["target"], {}, {}
+            parts = urlsplit(url)
+            if ip and parts.hostname and parts.hostname != ip:
+                # идём на уже разрешённый адрес, сохраняя Host и SNI исходного имени;
+                # netloc собираем заново, чтобы userinfo не попал в Host и не был испорчен заменой
+                port = f":{parts.port}" if parts.port else ""
+                host = f"[{parts.hostname}]" if ":" in parts.hostname else parts.hostname
+                userinfo = ""
+                if parts.username is not None:
+                    userinfo = parts.username + (f":{parts.password}" if parts.password is not None else "") + "@"
+                pinned = f"[{ip}]" if ":" in ip else ip
+                url = urlunsplit(parts._replace(netloc=f"{userinfo}{pinned}{port}"))
+                extensions = {"sni_hostname": parts.hostname}
+                headers = {"Host": f"{host}{port}"}
+            async with httpx.AsyncClient(follow_redirects=True) as client:
+                if extensions:
+                    # адрес и SNI закреплены только за первым запросом: httpx переносит extensions
+                    # на редиректы, а там уже может быть другой хост
+                    r = await client.get(url, timeout=5, headers=headers, extensions=extensions, follow_redirects=False)
+                    final_url = task["target"]
+                    if r.is_redirect:
+                        r = await client.get(urljoin(task["target"], r.headers["location"]), timeout=5)
+                        final_url = str(r.url)
+                else:
+                    r = await client.get(url, timeout=5)
+                    final_url = str(r.url)
+                data = {
+                    "headers": dict(r.headers),
+                    "url": final_url,
+                    "type": "http"
+                }
+                status = "ok" if r.status_code < 400 else "fail"
+                return Result(
                     id=task["id"],
-                    status="error",
-                    error=str(e),
-                    data={"type": task["type"]},
+                    status=status,
+                    code=r.status_code,
+                    response_time=time.time()-start,
+                    data=data,
                     group_id=task.get("group_id")
-                ))
-                await db.commit()
+                )
+
+        elif task["type"] == "ping":
+            proc = await asyncio.create_subprocess_shell(
+                f"/bin/ping -c 1 {ip or task['target']}",
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE)
+            out, err = await proc.communicate()
+            encoding = locale.getpreferredencoding(False)
+            out_decoded = out.decode(encoding, errors="replace")
+            err_decoded = err.decode(encoding, errors="replace")
+
+            ok = proc.returncode == 0
+            resp_time = None
+            if ok and "time=" in out_decoded:
+                try:
+                    line = out_decoded.split("time=")[1]
+                    resp_time = float(line.split(" ")[0])
+                except:
+                    pass
+
+            return Result(
+                id=task["id"],
+                status="ok" if ok else "fail",
+                response_time=resp_time,
+                data={
+                    "output": out_decoded,
+                    "type": "ping"
+                },
+                error=None if ok else err_decoded,
+                group_id=task.get("group_id")
+            )
+
+        elif task["type"] == "tcp":
+            host, port = task["target"], task.get("port", 80)
+            try:
+                reader, writer = await asyncio.open_connection(ip or host, port)
+                writer.close()
+                await writer.wait_closed()
+                ok = True
+                err = None
+            except Exception as e:
+                ok = False
+                err = str(e)
+            return Result(
+                id=task["id"],
+                status="ok" if ok else "fail",
+                response_time=time.time()-start,
+                data={
+                    "host": host,
+                    "port": port,
+                    "type": "tcp"
+                },
+                error=err,
+                group_id=task.get("group_id")
+            )
+
+        elif task["type"] == "traceroute":
+            proc = await asyncio.create_subprocess_shell(
+                f"/bin/traceroute -m 10 -w 2 {ip or task['target']}",
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE)
+            out, err = await proc.communicate()
+            ok = proc.returncode == 0
+            return Result(
+                id=task["id"],
+                status="ok" if ok else "fail",
+                response_time=time.time()-start,
+                data={
+                    "trace": out.decode().splitlines(),
+                    "type": "traceroute"
+                },
+                error=None if ok else err.decode(),
+                group_id=task.get("group_id")
+            )
+
+        elif task["type"] == "dns":
+            resolver = dns.asyncresolver.Resolver()
+            record_types = ["A", "AAAA", "MX", "NS", "TXT", "CNAME"]
+            answers = await asyncio.gather(
+                *(resolver.resolve(task["target"], rt) for rt in record_types),
+                return_exceptions=True
+            )
+            dns_results = {}
+            for rt, answer in zip(record_types, answers):
+                if isinstance(answer, Exception):
+                    dns_results[rt] = {"error": str(answer)}
+                else:
+                    dns_results[rt] = [rdata.to_text() for rdata in answer]
+            return Result(
+                id=task["id"],
+                status="ok",
+                response_time=time.time() - start,
+                data={
+                    "records": dns_results,
+                    "type": "dns"
+                },
+                group_id=task.get("group_id")
+            )
+
+    except Exception as e:
+        return Result(
+            id=task["id"],
+            status="error",
+            error=str(e),
+            data={"type": task["type"]},
+            group_id=task.get("group_id")
+        )
+
+
+async def run_full_check(db: AsyncSession, task: dict):
+    # Одно разрешение имени на всю группу, пробы параллельно, все результаты — одним коммитом
+    ip = await resolve_target(task["target"])
+    subtasks = [
+        {"id": sub["id"], "type": sub["type"], "port": sub.get("port"), "target": task["target"], "group_id": task["id"]}
+        for sub in task["subtasks"]
+    ]
+    results = await asyncio.gather(*(run_probe(sub, ip) for sub in subtasks))
+    results = [r for r in results if r is not None]
+    try:
+        db.add_all(results)
+        await db.commit()
+    except Exception as e:
+        # без результатов группа висела бы в pending до истечения кэша — пишем ошибки заново
+        await db.rollback()
+        print(f"⚠️ Full check {task['id']} commit failed: {e}")
+        results = [
+            Result(
+                id=sub["id"],
+                status="error",
+                error=f"Failed to store result: {e}",
+                data={"type": sub["type"]},
+                group_id=task["id"]
+            )
+            for sub in subtasks
+        ]
+        db.add_all(results)
+        await db.commit()
+    await asyncio.gather(*(cache_result(r) for r in results))
+
+
+async def worker(worker_id: int):
+    async with AsyncSessionLocal() as db:
+        while True:
+            task = await scheduler.next_task()
+            try:
+                if task["type"] == "full":
+                    await run_full_check(db, task)
+                else:
+                    res = await run_probe(task)
+                    if res is not None:
+                        await save_result(db, res)
+            except Exception as e:
+                await db.rollback()
+                print(f"⚠️ Worker {worker_id} failed on task {task['id']}: {e}")
+            finally:
+                scheduler.release(task)
 
 
 @app.post("/api/agents/register", tags=["Agents Req"])
@@ -389,7 +719,9 @@ async def reg_ag(req: AgentRegisterRequest, db: AsyncSession = Depends(get_db)):
         name=req.name,
         desc=req.desc,
         email=req.email,
-        api=api_key
+        api=api_key,
+        region=req.region,
+        labels=req.labels
     )
 
     db.add(new_agent)
@@ -402,7 +734,9 @@ async def reg_ag(req: AgentRegisterRequest, db: AsyncSession = Depends(get_db)):
         "api_key": api_key,
         "name": req.name,
         "desc": req.desc,
-        "email": req.email
+        "email": req.email,
+        "region": req.region,
+        "labels": req.labels
     }
 
 
@@ -426,7 +760,9 @@ async def get_agents(db: AsyncSession = Depends(get_db), current_admin: Admin =
             "email": agent.email,
             "status": "Active" if is_active else "Inactive",
             "api_key": agent.api,
-            "ip": agent.last_ip
+            "ip": agent.last_ip,
+            "region": agent.region,
+            "labels": agent.labels
         })
 
     total = len(agents)
@@ -466,12 +802,14 @@ async def login(req: AdminLoginRequest, db: AsyncSession = Depends(get_db)):
 @app.websocket("/ws/onlineag") #count
 async def ag_count(websocket: WebSocket):
     await websocket.accept()
+    await online_hub.subscribe(websocket)
     try:
         while True:
-            await websocket.send_json({"online": len(active_agents)})
-            await asyncio.sleep(1)
-    except WebSocketDisconnect:
+            await websocket.receive_text()
+    except (WebSocketDisconnect, RuntimeError):
         pass
+    finally:
+        online_hub.unsubscribe(websocket)
 
 
 @app.websocket("/ws/agent")
@@ -490,6 +828,10 @@ async def agent_ws(websocket: WebSocket, db: AsyncSession = Depends(get_db)):
         return
 
     client_ip = websocket.client.host
+    websocket.state.wire_format = negotiate_format(websocket.query_params.get("format"))
+    websocket.state.agent_name = agent.name
+    websocket.state.region = agent.region
+    websocket.state.labels = agent.labels or []
     active_agents[api_key] = websocket
     existing_active = await db.execute(select(ActiveAgents).where(ActiveAgents.api == api_key))
     existing_active = existing_active.scalar()
@@ -509,16 +851,19 @@ async def agent_ws(websocket: WebSocket, db: AsyncSession = Depends(get_db)):
 
     agent.last_ip = client_ip
     await db.commit()
+    await online_hub.agent_online(api_key)
 
     print(f"🟢 Агент приконекчен: {agent.name} | IP: {client_ip}")
+    if websocket.query_params.get("format"):
+        await send_frame(websocket, {"type": "hello", "format": websocket.state.wire_format})
 
     try:
         while True:
-            message = await websocket.receive_text()
-            data = json.loads(message)
+            data = await receive_frame(websocket)
 
             if data.get("type") == "result":
                 result_data = data["result"]
+                lease = await release_lease(result_data["id"])
                 print(f"Результат получен от агента {agent.name} | {result_data['status']} | {result_data.get('response_time', 'N/A')}")
 
                 existing = await db.get(Result, result_data["id"])
@@ -529,7 +874,10 @@ async def agent_ws(websocket: WebSocket, db: AsyncSession = Depends(get_db)):
                         code=result_data.get("code"),
                         response_time=result_data.get("response_time"),
                         data=result_data.get("data"),
-                        error=result_data.get("error")
+                        error=result_data.get("error"),
+                        group_id=lease["task"].get("group_id") if lease else None,
+                        agent=agent.name,
+                        region=agent.region
                     )
                     db.add(new_result)
                 else:
@@ -538,34 +886,116 @@ async def agent_ws(websocket: WebSocket, db: AsyncSession = Depends(get_db)):
                     existing.response_time = result_data.get("response_time")
                     existing.data = result_data.get("data")
                     existing.error = result_data.get("error")
+                    existing.agent = agent.name
+                    existing.region = agent.region
 
                 await db.commit()
+                await cache_result(existing or new_result)
 
     except WebSocketDisconnect:
         print(f"🔴 Агент потерялся: {agent.name}")
-        result = await db.execute(select(ActiveAgents).where(ActiveAgents.api == api_key))
-        active_record = result.scalar()
-        if active_record:
-            await db.delete(active_record)
-            await db.commit()
-        if api_key in active_agents:
+    finally:
+        # агент мог уже переподключиться — тогда чистить нечего
+        if active_agents.get(api_key) is websocket:
             del active_agents[api_key]
+            result = await db.execute(select(ActiveAgents).where(ActiveAgents.api == api_key))
+            active_record = result.scalar()
+            if active_record:
+                await db.delete(active_record)
+                await db.commit()
+            await online_hub.agent_offline(api_key)
+            await requeue_agent_leases(api_key)
+
+async def grant_lease(task_data: dict, api_key: str, attempt: int):
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(LEASE_DATA_KEY, task_data["id"], dumps({"task": task_data, "agent": api_key, "attempt": attempt}))
+        pipe.zadd(LEASE_KEY, {task_data["id"]: time.time() + LEASE_TIMEOUT})
+        pipe.sadd(f"agent_leases:{api_key}", task_data["id"])
+        await pipe.execute()
+
+
+async def release_lease(task_id: str) -> dict | None:
+    raw = await claim_lease_script(keys=[LEASE_KEY, LEASE_DATA_KEY], args=[task_id])
+    if not raw:
+        return None
+    lease = loads(raw)
+    await redis_client.srem(f"agent_leases:{lease['agent']}", task_id)
+    return lease
+
+
+async def redeliver(lease: dict, reason: str):
+    task = lease["task"]
+    if lease["attempt"] >= LEASE_MAX_ATTEMPTS:
+        print(f"❌ Task {task['id']} dropped after {lease['attempt']} attempts: {reason}")
+        async with AsyncSessionLocal() as db:
+            await save_result(db, Result(
+                id=task["id"],
+                status="error",
+                error=f"{reason} after {lease['attempt']} attempts",
+                data={"type": task["type"]},
+                group_id=task.get("group_id")
+            ))
+        return
+
+    print(f"🔁 Task {task['id']} redelivered ({reason}), attempt {lease['attempt'] + 1}")
+    await dispatch_task(task, attempt=lease["attempt"] + 1, exclude=lease["agent"])
+
+
+async def requeue_agent_leases(api_key: str):
+    for task_id in await redis_client.smembers(f"agent_leases:{api_key}"):
+        lease = await release_lease(task_id)
+        if lease:
+            await redeliver(lease, "agent disconnected")
+
 
-async def dispatch_task(task_data: dict):
-    if active_agents:
-        import random
-        api_key = random.choice(list(active_agents.keys()))
+async def lease_reaper():
+    while True:
+        await asyncio.sleep(1)
+        try:
+            for task_id in await redis_client.zrangebyscore(LEASE_KEY, 0, time.time()):
+                lease = await release_lease(task_id)
+                if lease:
+                    await redeliver(lease, "lease expired")
+        except Exception as e:
+            print(f"⚠️ Lease reaper error: {e}")
+
+
+async def dispatch_task(task_data: dict, attempt: int = 1, exclude: str | None = None, api_key: str | None = None):
+    if api_key not in active_agents:
+        candidates = [k for k in active_agents if k != exclude]
+        # при передоставке fan-out задачи стараемся остаться в том же регионе
+        same_region = [k for k in candidates if task_data.get("region") and active_agents[k].state.region == task_data["region"]]
+        api_key = random.choice(same_region or candidates) if candidates else None
+    if api_key:
         ws = active_agents[api_key]
         try:
-            await ws.send_text(json.dumps({
+            # аренда выдаётся до отправки, чтобы быстрый результат не обогнал её
+            await grant_lease(task_data, api_key, attempt)
+            await send_frame(ws, {
                 "type": "task",
                 "task_id": task_data["id"],
                 "data": task_data
-            }))
+            })
+            return
         except Exception as e:
-            await redis_client.lpush("task_queue", json.dumps(task_data))
-    else:
-        await redis_client.lpush("task_queue", json.dumps(task_data))
+            await release_lease(task_data["id"])
+
+    if task_data.get("vantage"):
+        # проверка с центрального сервера не даёт вид из региона — засчитываем точку как упавшую
+        vantage = task_data["vantage"]
+        print(f"❌ Fan-out task {task_data['id']}: no agent left for vantage {vantage['agent']} ({vantage['region']})")
+        async with AsyncSessionLocal() as db:
+            await save_result(db, Result(
+                id=task_data["id"],
+                status="error",
+                error="No agent available for this vantage",
+                data={"type": task_data["type"]},
+                group_id=task_data.get("group_id"),
+                agent=vantage["agent"],
+                region=vantage["region"]
+            ))
+        return
+    await scheduler.enqueue(task_data, task_data.get("priority") or "interactive")
 
 
 @app.post("/api/admin/register", tags=["Admin Reqs"])
@@ -584,4 +1014,4 @@ async def register_admin(req: AdminLoginRequest, db: AsyncSession = Depends(get_
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True, ws_ping_interval=10, ws_ping_timeout=10)
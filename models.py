@@ -1,5 +1,7 @@
 from sqlalchemy import Column, String, Float, JSON, Text
+from sqlalchemy.orm import deferred
 from database import Base
+from codec import PackedJSON
 
 class Task(Base):
     __tablename__ = "tasks"
@@ -19,9 +21,11 @@ class Result(Base):
     status = Column(String)
     code = Column(Float, nullable=True)
     response_time = Column(Float, nullable=True)
-    data = Column(JSON, nullable=True)
+    data = deferred(Column(PackedJSON, nullable=True))
     error = Column(Text, nullable=True)
     group_id = Column(String, nullable=True, index=True)
+    agent = Column(String, nullable=True)
+    region = Column(String, nullable=True)
 
 class Agents(Base):
     __tablename__ = "agents"
@@ -33,6 +37,8 @@ class Agents(Base):
     email = Column(String, nullable=True)
     last_ip = Column(String, nullable=True)
     api = Column(String, nullable=True)
+    region = Column(String, nullable=True)
+    labels = Column(JSON, nullable=True)
 
 class ActiveAgents(Base):
     __tablename__ = "active_agents"
@@ -0,0 +1,125 @@
+import asyncio
+import time
+
+from fastapi import WebSocket
+
+from serialization import dumps
+
+# sorted set: api_key -> время истечения; живые процессы продлевают своих агентов,
+# записи упавшего процесса сами протухают через ONLINE_TTL
+ONLINE_KEY = "agents:alive"
+ONLINE_CHANNEL = "agents:online:events"
+ONLINE_TTL = 30
+
+
+# Один издатель числа онлайн-агентов на процесс: счётчик общий для кластера (Redis + pub/sub),
+# изменения склеиваются за coalesce секунд, раз в keepalive число перечитывается и шлётся повторно,
+# подписчик, не принявший кадр за send_timeout, отключается
+class OnlineHub:
+    def __init__(self, redis_client, coalesce: float = 0.25, keepalive: float = 15, send_timeout: float = 2):
+        self.redis = redis_client
+        self.coalesce = coalesce
+        self.keepalive = keepalive
+        self.send_timeout = send_timeout
+        self.subscribers: set[WebSocket] = set()
+        self.local: set[str] = set()
+        self.count = 0
+        self.changed = asyncio.Event()
+
+    async def agent_online(self, api_key: str):
+        self.local.add(api_key)
+        if await self.redis.zadd(ONLINE_KEY, {api_key: time.time() + ONLINE_TTL}):
+            await self.redis.publish(ONLINE_CHANNEL, api_key)
+
+    async def agent_offline(self, api_key: str):
+        self.local.discard(api_key)
+        if await self.redis.zrem(ONLINE_KEY, api_key):
+            await self.redis.publish(ONLINE_CHANNEL, api_key)
+
+    async def subscribe(self, ws: WebSocket):
+        self.subscribers.add(ws)
+        await self._send(ws, dumps({"online": self.count}).decode())
+
+    def unsubscribe(self, ws: WebSocket):
+        self.subscribers.discard(ws)
+
+    async def run(self):
+        refresher = asyncio.create_task(self._refresh())
+        listener = asyncio.create_task(self._listen())
+        try:
+            while True:
+                try:
+                    await self._tick()
+                except Exception as e:
+                    print(f"⚠️ Online hub error: {e}")
+                    await asyncio.sleep(1)
+        finally:
+            refresher.cancel()
+            listener.cancel()
+
+    async def _tick(self):
+        try:
+            await asyncio.wait_for(self.changed.wait(), self.keepalive)
+        except asyncio.TimeoutError:
+            self.count = await self._count()
+            await self._broadcast()
+            return
+
+        await asyncio.sleep(self.coalesce)
+        self.changed.clear()
+        count = await self._count()
+        if count != self.count:
+            self.count = count
+            await self._broadcast()
+
+    async def _count(self) -> int:
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(ONLINE_KEY, 0, time.time())
+            pipe.zcard(ONLINE_KEY)
+            expired, count = await pipe.execute()
+        if expired:
+            await self.redis.publish(ONLINE_CHANNEL, "expired")
+        return count
+
+    async def _refresh(self):
+        while True:
+            await asyncio.sleep(ONLINE_TTL / 3)
+            try:
+                if self.local:
+                    deadline = time.time() + ONLINE_TTL
+                    await self.redis.zadd(ONLINE_KEY, {api_key: deadline for api_key in self.local})
+                await self._count()
+            except Exception as e:
+                print(f"⚠️ Online agents refresh failed: {e}")
+
+    async def _listen(self):
+        # pub/sub обрывается при переподключении к Redis — переподписываемся
+        while True:
+            try:
+                pubsub = self.redis.pubsub()
+                await pubsub.subscribe(ONLINE_CHANNEL)
+                self.changed.set()
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self.changed.set()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Online hub listener reconnecting: {e}")
+                await asyncio.sleep(1)
+
+    async def _broadcast(self):
+        if not self.subscribers:
+            return
+        frame = dumps({"online": self.count}).decode()
+        await asyncio.gather(*(self._send(ws, frame) for ws in list(self.subscribers)))
+
+    async def _send(self, ws: WebSocket, frame: str):
+        try:
+            await asyncio.wait_for(ws.send_text(frame), self.send_timeout)
+        except Exception:
+            self.unsubscribe(ws)
+            try:
+                await ws.close(code=1013)
+            except Exception:
+                pass
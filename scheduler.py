@@ -0,0 +1,121 @@
+import asyncio
+import os
+
+from serialization import dumps, loads
+
+LEGACY_QUEUE = "task_queue"
+LANES = ("interactive", "bulk")
+
+
+def parse_weights(value: str | None, default: dict) -> dict:
+    # "tcp=4,traceroute=1" -> {"tcp": 4, "traceroute": 1}
+    if not value:
+        return dict(default)
+    weights = dict(default)
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        weights[name.strip()] = int(weight)
+    return weights
+
+
+TYPE_WEIGHTS = parse_weights(os.getenv("QUEUE_WEIGHTS"), {"tcp": 4, "http": 4, "ping": 4, "dns": 2, "traceroute": 1, "full": 1})
+LANE_WEIGHTS = parse_weights(os.getenv("LANE_WEIGHTS"), {"interactive": 8, "bulk": 1})
+TYPE_CONCURRENCY = parse_weights(os.getenv("TYPE_CONCURRENCY"), {"dns": 3, "traceroute": 2, "full": 2})
+
+# Забирает задачу из первой непустой очереди и заодно сообщает, какие очереди вообще непусты
+POP_FIRST_LUA = """
+local active = {}
+local popped_key, value
+for _, key in ipairs(KEYS) do
+    if redis.call('LLEN', key) > 0 then
+        table.insert(active, key)
+        if not value then
+            popped_key = key
+            value = redis.call('RPOP', key)
+        end
+    end
+end
+if not value then
+    return false
+end
+return {popped_key, value, active}
+"""
+
+
+def queue_key(check_type: str, lane: str) -> str:
+    return f"task_queue:{lane}:{check_type}"
+
+
+# Очередь на каждую пару (приоритет, тип проверки). Воркеры выбирают очередь
+# сглаженным взвешенным round-robin (вес = вес приоритета * вес типа),
+# пропуская типы, упёршиеся в лимит одновременных задач в этом процессе
+class Scheduler:
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self.pop_first = redis_client.register_script(POP_FIRST_LUA)
+        self.weights = {
+            queue_key(t, lane): LANE_WEIGHTS.get(lane, 1) * w
+            for lane in LANES for t, w in TYPE_WEIGHTS.items()
+        }
+        self.weights[LEGACY_QUEUE] = 1
+        self.types = {queue_key(t, lane): t for lane in LANES for t in TYPE_WEIGHTS}
+        self.current = dict.fromkeys(self.weights, 0)
+        self.in_flight = dict.fromkeys(TYPE_WEIGHTS, 0)
+        self.lock = asyncio.Lock()
+
+    async def enqueue(self, task_data: dict, lane: str = "interactive"):
+        if task_data["type"] in TYPE_WEIGHTS and lane in LANES:
+            key = queue_key(task_data["type"], lane)
+        else:
+            key = LEGACY_QUEUE
+        await self.redis.lpush(key, dumps(task_data))
+
+    def _eligible(self) -> list[str]:
+        return [
+            key for key in self.weights
+            if key not in self.types
+            or self.in_flight[self.types[key]] < TYPE_CONCURRENCY.get(self.types[key], float("inf"))
+        ]
+
+    def _order(self, keys: list[str]) -> list[str]:
+        return sorted(keys, key=lambda k: self.current[k] + self.weights[k], reverse=True)
+
+    def _charge(self, keys: list[str], active: list[str], key: str):
+        # сглаженный WRR только по непустым очередям, пустые не копят кредит
+        for k in keys:
+            if k in active:
+                self.current[k] += self.weights[k]
+            else:
+                self.current[k] = 0
+        self.current[key] -= sum(self.weights[k] for k in active)
+
+    async def next_task(self) -> dict:
+        while True:
+            async with self.lock:
+                keys = self._eligible()
+                popped = await self.pop_first(keys=self._order(keys))
+                if popped:
+                    key, raw, active = popped
+                else:
+                    # всё пусто — блокируемся, порядок ключей задаёт приоритет
+                    by_priority = sorted(keys, key=lambda k: self.weights[k], reverse=True)
+                    popped = await self.redis.brpop(by_priority, timeout=1)
+                    if not popped:
+                        continue
+                    key, raw = popped
+                    active = [key]
+                self._charge(keys, active, key)
+                task = loads(raw)
+                if task.get("type") in self.in_flight:
+                    self.in_flight[task["type"]] += 1
+            return task
+
+    async def depth(self) -> int:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in self.weights:
+                pipe.llen(key)
+            return sum(await pipe.execute())
+
+    def release(self, task: dict):
+        if task.get("type") in self.in_flight and self.in_flight[task["type"]] > 0:
+            self.in_flight[task["type"]] -= 1
@@ -0,0 +1,44 @@
+import orjson
+from fastapi import WebSocket, WebSocketDisconnect
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Форматы кадров агента: json — текстовые кадры (старый протокол), msgpack — бинарные
+JSON_FORMAT = "json"
+MSGPACK_FORMAT = "msgpack"
+
+
+def dumps(obj) -> bytes:
+    return orjson.dumps(obj)
+
+
+def loads(data):
+    return orjson.loads(data)
+
+
+def negotiate_format(requested: str | None) -> str:
+    if requested == MSGPACK_FORMAT and msgpack is not None:
+        return MSGPACK_FORMAT
+    return JSON_FORMAT
+
+
+async def send_frame(ws: WebSocket, obj):
+    if getattr(ws.state, "wire_format", JSON_FORMAT) == MSGPACK_FORMAT:
+        await ws.send_bytes(msgpack.packb(obj))
+    else:
+        await ws.send_text(orjson.dumps(obj).decode())
+
+
+async def receive_frame(ws: WebSocket):
+    # Принимаем оба вида кадров независимо от согласованного формата
+    message = await ws.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    if message.get("bytes") is not None:
+        if msgpack is None:
+            raise ValueError("msgpack frames are not supported")
+        return msgpack.unpackb(message["bytes"])
+    return orjson.loads(message["text"])